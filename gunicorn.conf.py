@@ -0,0 +1,12 @@
+# Configuração do Gunicorn referenciada no Dockerfile (CMD ... -c gunicorn.conf.py).
+# O worker do Uvicorn ativa o loop uvloop e o parser HTTP httptools (ambos em C,
+# instalados via uvicorn[standard]) — num proxy IO-bound como este, em que quase
+# todo o tempo é await de rede, o loop nativo rende 2-4x sobre o selector padrão.
+import multiprocessing
+import os
+
+bind = "0.0.0.0:80"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+# Keep-alive acima do padrão (2s) para reaproveitar conexões de clientes e probes.
+keepalive = 30
@@ -1,16 +1,34 @@
+import asyncio
+from array import array
+import math
 import os
 import logging
-from fastapi import FastAPI, HTTPException
+import time
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 
+import httpx
+import orjson
+from azure.core.exceptions import HttpResponseError
 from azure.identity.aio import DefaultAzureCredential
-from azure.identity import get_bearer_token_provider_async
-from azure.ai.openai.aio import AsyncAzureOpenAI
+from openai import APIError, APIStatusError, AsyncAzureOpenAI
 from dotenv import load_dotenv
 
-# Configurar logging básico
-logging.basicConfig(level=logging.INFO)
+# Configurar logging uma única vez, com nível vindo do ambiente: em produção
+# (LOG_LEVEL=WARNING) a linha de INFO por requisição vira apenas uma checagem de
+# nível, já que as chamadas de logger usam argumentos %-lazy. O formato com
+# campos fixos (timestamp, nível, logger, mensagem) é estruturado o bastante
+# para os agregadores de log fazerem o parse sem regex ad-hoc.
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    force=True,
+)
 logger = logging.getLogger(__name__)
 
 # Carregar variáveis de ambiente de um arquivo .env (para desenvolvimento local)
@@ -20,7 +38,10 @@ load_dotenv()
 app = FastAPI(
     title="Azure RAG FastAPI Application",
     description="Uma API para interagir com um modelo RAG usando Azure OpenAI e Azure AI Search.",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson (extensão em C) serializa as respostas JSON — incluindo as citações,
+    # que carregam strings longas — várias vezes mais rápido que o json da stdlib.
+    default_response_class=ORJSONResponse
 )
 
 # Variáveis de Ambiente (configure-as no seu Azure App Service)
@@ -28,7 +49,7 @@ AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_GPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_GPT_DEPLOYMENT") # Ex: gpt-4o-mini [cite: 128]
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") # Ex: text-embedding-ada-002 [cite: 54]
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_SERVICE_URL") # Nome da variável conforme doc [cite: 69]
-AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME") [cite: 69]
+AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME") # [cite: 69]
 # A API version mencionada no documento é "2024-10-21"[cite: 115].
 # Se esta for uma versão preview específica necessária, use-a. Caso contrário, uma mais recente estável.
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
@@ -43,13 +64,23 @@ required_env_vars = {
     "AZURE_SEARCH_INDEX_NAME": AZURE_SEARCH_INDEX_NAME,
 }
 
-missing_vars = [var for var, val in required_env_vars.items() if val is None]
+# frozenset: imutável e com pertinência O(1) — o conjunto é calculado uma única
+# vez no import e nenhum caminho posterior deve poder alterá-lo.
+missing_vars = frozenset(var for var, val in required_env_vars.items() if val is None)
 if missing_vars:
-    error_message = f"Erro crítico: As seguintes variáveis de ambiente não estão configuradas: {', '.join(missing_vars)}"
+    error_message = f"Erro crítico: As seguintes variáveis de ambiente não estão configuradas: {', '.join(sorted(missing_vars))}"
     logger.error(error_message)
-    # Em um cenário de produção, você pode querer que o app falhe ao iniciar.
-    # Para este exemplo, apenas logamos, mas o app provavelmente não funcionará corretamente.
-    # raise EnvironmentError(error_message) # Descomente para falhar se variáveis estiverem faltando
+    # Fail-fast: melhor o worker morrer no boot (e o orquestrador acusar o deploy
+    # quebrado) do que subir meio-configurado e responder 500 em cada requisição.
+    # FAIL_FAST=0 preserva o comportamento antigo para desenvolvimento local.
+    if os.getenv("FAIL_FAST", "1") != "0":
+        raise RuntimeError(error_message)
+
+# Estado de configuração pré-computado: as variáveis de ambiente não mudam depois
+# do import, então o caminho quente não precisa reavaliar all(...) nem re-juntar a
+# lista de faltantes a cada requisição.
+CONFIG_OK = not missing_vars
+MISSING_VARS_DETAIL = f"Configuração incompleta do servidor. Variáveis faltando: {', '.join(sorted(missing_vars))}"
 
 
 # Modelos Pydantic para Request e Response
@@ -59,6 +90,7 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
+    stream: bool = False # Quando True, a resposta é enviada por SSE em vez de JSON único
     # Você pode adicionar mais campos aqui, como conversation_id para gerenciar o histórico
 
 class Citation(BaseModel):
@@ -76,107 +108,653 @@ class ChatCompletionMessage(BaseModel):
 class ChatResponse(BaseModel):
     message: ChatCompletionMessage
 
+# Prompt de sistema pré-montado no import: o texto é estático, então o literal é
+# alocado uma única vez em vez de ser reconstruído a cada requisição.
+SYSTEM_PROMPT = (
+    "Você é um assistente de IA útil que responde perguntas "
+    "com base nos documentos fornecidos."
+)
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+# Orçamento de tokens: limita o tamanho da pergunta enviada ao modelo e o número de
+# documentos que o "on your data" injeta no prompt. Sem isso, custo e latência do
+# completion crescem linearmente com o tamanho da entrada do usuário.
+AZURE_OPENAI_CONTEXT_TOKEN_BUDGET = int(os.getenv("AZURE_OPENAI_CONTEXT_TOKEN_BUDGET", "2048"))
+AZURE_SEARCH_TOP_N_DOCUMENTS = int(os.getenv("AZURE_SEARCH_TOP_N_DOCUMENTS", "5"))
+
+# Campos de conteúdo do índice (separados por vírgula). Quando configurado, o
+# "on your data" lê apenas esses campos em vez de todas as colunas armazenadas —
+# índices costumam guardar embeddings e metadados junto ao texto, e esse payload
+# extra só engorda o tráfego entre o Azure OpenAI e o Search.
+AZURE_SEARCH_CONTENT_FIELDS = [
+    field.strip()
+    for field in os.getenv("AZURE_SEARCH_CONTENT_FIELDS", "").split(",")
+    if field.strip()
+]
+
+# Fonte de dados (Azure AI Search) [cite: 117, 121] montada uma única vez no
+# import: todos os campos derivam de variáveis de ambiente que não mudam, então
+# não há motivo para realocar o dict aninhado (e a f-string da configuração
+# semântica) a cada requisição — o objeto é passado por referência no extra_body.
+# Se algum caminho futuro precisar de override por requisição, copie os
+# parameters ({**DATA_SOURCE["parameters"], ...}) apenas nesse caminho.
+DATA_SOURCE = {
+    "type": "azure_search",
+    "parameters": {
+        "endpoint": AZURE_SEARCH_ENDPOINT,
+        "index_name": AZURE_SEARCH_INDEX_NAME,
+        "authentication": {
+            "type": "system_assigned_managed_identity" # [cite: 4, 117]
+        },
+        "query_type": "vector_semantic_hybrid", # [cite: 121]
+        "semantic_configuration": f"{AZURE_SEARCH_INDEX_NAME}-semantic-configuration", # [cite: 121, 125]
+        "embedding_dependency": { # [cite: 121]
+            "type": "deployment_name",
+            "deployment_name": AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+        },
+        # Limita quantos documentos o serviço injeta no prompt do modelo:
+        # tokens de entrada (custo e latência) escalam com esse valor.
+        "top_n_documents": AZURE_SEARCH_TOP_N_DOCUMENTS,
+        # Outros parâmetros opcionais:
+        # "strictness": 3,
+        # "in_scope": True, # Forçar o modelo a usar apenas os dados do índice
+        # "role_information": "Você é um assistente de IA que ajuda usuários com informações de documentos."
+    }
+}
+
+# Restringe a leitura aos campos de conteúdo configurados (payload menor).
+if AZURE_SEARCH_CONTENT_FIELDS:
+    DATA_SOURCE["parameters"]["fields_mapping"] = {
+        "content_fields": AZURE_SEARCH_CONTENT_FIELDS
+    }
+
+try:
+    import tiktoken
+    _token_encoder = tiktoken.get_encoding("cl100k_base")
+except Exception: # tiktoken pode falhar sem acesso ao vocabulário (ambiente offline)
+    _token_encoder = None
+
+
+def _trim_to_token_budget(text: str, budget: int) -> str:
+    # Corta o texto no limite de tokens; sem tiktoken, usa a aproximação de ~4
+    # caracteres por token para não estourar o orçamento por muito.
+    if _token_encoder is not None:
+        tokens = _token_encoder.encode(text)
+        if len(tokens) <= budget:
+            return text
+        return _token_encoder.decode(tokens[:budget])
+    max_chars = budget * 4
+    return text if len(text) <= max_chars else text[:max_chars]
+
+
+@lru_cache(maxsize=4096)
+def _normalize_query(text: str) -> str:
+    # Normaliza o texto usado como chave de cache: NFKC + minúsculas + colapso de
+    # espaços. Variações triviais da mesma pergunta (caixa, espaçamento, formas
+    # Unicode equivalentes) passam a compartilhar a mesma entrada nos caches,
+    # aumentando a taxa de acerto. O texto original segue intacto para o modelo.
+    # O lru_cache evita refazer NFKC + split/join para as mensagens de histórico,
+    # que se repetem idênticas a cada turno da mesma conversa.
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+# Cache exato (pergunta -> resposta) na frente do cache semântico: um lookup de
+# dict custa nanossegundos, contra a chamada de embedding (~dezenas de ms) que o
+# cache semântico exige. Perguntas repetidas à risca dominam a cabeça da
+# distribuição de tráfego em produção.
+EXACT_CACHE_MAX_ENTRIES = int(os.getenv("EXACT_CACHE_MAX_ENTRIES", "1024"))
+EXACT_CACHE_TTL_SECONDS = float(os.getenv("EXACT_CACHE_TTL_SECONDS", "300"))
+
+
+class TTLCache:
+    """LRU com TTL sobre OrderedDict — o suficiente para o cache exato,
+    sem adicionar dependência externa."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # chave -> (timestamp de expiração, valor)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        elif len(self._entries) >= self._max_entries:
+            self._entries.popitem(last=False) # Descarta o menos recentemente usado
+        self._entries[key] = (time.monotonic() + self._ttl_seconds, value)
+
+
+exact_cache = TTLCache(max_entries=EXACT_CACHE_MAX_ENTRIES, ttl_seconds=EXACT_CACHE_TTL_SECONDS)
+
+# Cache de embeddings (texto normalizado -> vetor): a sonda do cache semântico
+# precisa do embedding da pergunta mesmo quando a resposta ainda não está
+# cacheada; memorizar o vetor evita pagar a chamada de embedding de novo para
+# textos já vistos. Embeddings são determinísticos por modelo, então o TTL pode
+# ser bem mais longo que o dos caches de resposta.
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "3600"))
+
+embedding_cache = TTLCache(max_entries=EMBEDDING_CACHE_MAX_ENTRIES, ttl_seconds=EMBEDDING_CACHE_TTL_SECONDS)
+
+
+# Cache semântico de respostas: perguntas quase idênticas (reformulações, variações
+# de pontuação) curto-circuitam a chamada de chat completion — que domina a latência
+# (segundos) e o custo em tokens — devolvendo a resposta já gerada para a pergunta
+# mais parecida, quando a similaridade de cosseno passa do limiar configurado.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+
+try:
+    import numpy as _np
+except Exception: # numpy é opcional; sem ele a busca cai no caminho puro-Python
+    _np = None
+
+# Sem numpy, a varredura é um laço Python síncrono (~0,1 ms por entrada de 1536
+# dims) que bloqueia o event loop; o padrão cai para 32 entradas para manter a
+# sonda na casa de poucos ms. Com numpy, cada produto interno é uma chamada
+# vetorizada e 512 entradas custam ~1 ms.
+SEMANTIC_CACHE_MAX_ENTRIES = int(
+    os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "512" if _np is not None else "32")
+)
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "300"))
+
+
+class SemanticCache:
+    """Cache em memória de (embedding da pergunta -> resposta serializada) com TTL.
+
+    A busca é linear sobre vetores já normalizados (produto interno == cosseno).
+    Com numpy, cada produto interno int8 é uma chamada vetorizada e a varredura
+    completa fica na casa de 1 ms; sem numpy, o laço puro-Python bloqueia o event
+    loop, por isso o limite padrão de entradas é bem menor nesse caso.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._threshold = threshold
+        # Buffer circular de tuplas (vetor int8, escala, expiração, resposta): o
+        # deque com maxlen tem capacidade fixa conhecida e descarta a entrada mais
+        # antiga em C ao encher, em vez do pop(0) O(n) de uma lista.
+        self._entries = deque(maxlen=max_entries)
+
+    @staticmethod
+    def _quantize(embedding):
+        """Normaliza e quantiza o vetor para int8 com escala afim por vetor.
+
+        Um embedding de 1536 dimensões em lista de floats Python custa ~6 KB só
+        de payload (e bem mais contando o overhead de PyFloat); em array('b') são
+        1536 bytes contíguos. O cosseno é recuperado multiplicando o produto
+        interno inteiro pelas escalas dos dois vetores.
+        """
+        norm = math.sqrt(sum(x * x for x in embedding))
+        if norm == 0.0:
+            return None
+        normalized = [x / norm for x in embedding]
+        scale = max(abs(x) for x in normalized) / 127.0
+        if scale == 0.0:
+            return None
+        if _np is not None:
+            quantized = _np.rint(_np.asarray(normalized) / scale).astype(_np.int8)
+        else:
+            quantized = array("b", (round(x / scale) for x in normalized))
+        return quantized, scale
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        if any(entry[2] <= now for entry in self._entries):
+            self._entries = deque(
+                (entry for entry in self._entries if entry[2] > now),
+                maxlen=self._max_entries,
+            )
+
+    def get(self, embedding) -> Optional[bytes]:
+        self._evict_expired()
+        if not self._entries:
+            return None
+        query = self._quantize(embedding)
+        if query is None:
+            return None
+        query_vector, query_scale = query
+        if _np is not None:
+            # Acumula em int32 (o dot em int8 puro estouraria) uma única vez por sonda.
+            query_vector = query_vector.astype(_np.int32)
+        best_score = -1.0
+        best_response = None
+        for vector, scale, _expires_at, response in self._entries:
+            # Produto interno em int8; as escalas devolvem a magnitude do cosseno.
+            if _np is not None:
+                dot = int(query_vector @ vector)
+            else:
+                dot = sum(a * b for a, b in zip(query_vector, vector))
+            score = dot * scale * query_scale
+            if score > best_score:
+                best_score = score
+                best_response = response
+        if best_score >= self._threshold:
+            return best_response
+        return None
+
+    def put(self, embedding, response: bytes):
+        quantized = self._quantize(embedding)
+        if quantized is None:
+            return
+        vector, scale = quantized
+        self._evict_expired()
+        # Com maxlen, o próprio deque descarta a entrada mais antiga ao encher.
+        self._entries.append((vector, scale, time.monotonic() + self._ttl_seconds, response))
+
+
+semantic_cache = SemanticCache(
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+)
+
 
 # Inicializar o cliente Azure OpenAI de forma assíncrona
 # Usaremos DefaultAzureCredential para autenticação via Identidade Gerenciada no Azure [cite: 115]
-try:
-    credential = DefaultAzureCredential()
-    # O token provider é necessário para AsyncAzureOpenAI com azure_ad_token_provider
-    # A scope é para o serviço cognitivo do Azure [cite: 115]
-    token_provider = get_bearer_token_provider_async(credential, "https://cognitiveservices.azure.com/.default")
+# A fábrica é cacheada (singleton) para que o mesmo cliente — e portanto o mesmo pool
+# de conexões HTTP e o mesmo cache de tokens AAD — seja reutilizado em todas as requisições,
+# em vez de pagar handshake TCP/TLS e obtenção de token a cada chamada.
+# A scope é para o serviço cognitivo do Azure [cite: 115]
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+@lru_cache(maxsize=1)
+def get_credential() -> DefaultAzureCredential:
+    # DefaultAzureCredential sonda várias fontes de autenticação (env, IMDS, CLI) —
+    # centenas de ms no caminho frio — e mantém o token AAD em cache em memória
+    # (válido ~1h). Uma única instância por processo evita repetir essa sondagem.
+    return DefaultAzureCredential()
+
+
+# Margem de renovação antecipada do token AAD (o JWT vale ~1h; renovamos antes).
+TOKEN_REFRESH_MARGIN_SECONDS = 300.0
+
+
+@lru_cache(maxsize=1)
+def get_token_provider():
+    """Provider de token AAD com cache explícito por expiração.
+
+    O provider do azure-identity consulta a credencial a cada chamada; aqui o JWT
+    é reutilizado direto da memória até a margem antes do `expires_on`, então o
+    caminho quente não toca IMDS/AAD. O lock evita a debandada de renovações
+    simultâneas quando o token expira sob concorrência.
+    """
+    cached_token = None # azure.core.credentials.AccessToken (token, expires_on)
+    refresh_lock = asyncio.Lock()
+
+    async def token_provider() -> str:
+        nonlocal cached_token
+        if cached_token is not None and time.time() < cached_token.expires_on - TOKEN_REFRESH_MARGIN_SECONDS:
+            return cached_token.token
+        async with refresh_lock:
+            # Revalida após adquirir o lock: outra corrotina pode ter renovado.
+            if cached_token is None or time.time() >= cached_token.expires_on - TOKEN_REFRESH_MARGIN_SECONDS:
+                cached_token = await get_credential().get_token(COGNITIVE_SERVICES_SCOPE)
+        return cached_token.token
+
+    return token_provider
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    # Pool HTTP compartilhado e dimensionado explicitamente, em vez do pool default
+    # que o SDK da OpenAI criaria (10 conexões keep-alive). Sob carga concorrente o
+    # pool pequeno serializa requisições; aqui o keep-alive é maximizado e o HTTP/2
+    # permite multiplexar completions e embeddings na mesma conexão com o frontend.
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "200")),
+            max_keepalive_connections=int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "100")),
+            keepalive_expiry=30.0,
+        ),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+
 
-    openai_client = AsyncAzureOpenAI(
+@lru_cache(maxsize=1)
+def get_openai_client() -> AsyncAzureOpenAI:
+    return AsyncAzureOpenAI(
         azure_endpoint=AZURE_OPENAI_ENDPOINT,
         api_version=AZURE_OPENAI_API_VERSION,
-        azure_ad_token_provider=token_provider
+        azure_ad_token_provider=get_token_provider(),
+        http_client=get_http_client()
     )
-except Exception as e:
-    logger.error(f"Falha ao inicializar o cliente Azure OpenAI ou credenciais: {e}")
-    openai_client = None # Garante que o cliente não seja usado se a inicialização falhar
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat_completion(request: ChatRequest):
-    if not openai_client:
-        raise HTTPException(status_code=503, detail="Serviço OpenAI não está disponível devido a erro de configuração.")
-    if not all(required_env_vars.values()): # Verifica novamente se todas as vars estão carregadas
-         raise HTTPException(status_code=500, detail=f"Configuração incompleta do servidor. Variáveis faltando: {', '.join(missing_vars)}")
+openai_client: Optional[AsyncAzureOpenAI] = None # Preenchido no evento de startup
+_warmup_complete = False # Vira True após o pré-aquecimento; usado pela sonda /ready
+
 
+@app.on_event("startup")
+async def startup_event():
+    # Constrói o cliente uma única vez na subida do processo, fora do caminho crítico
+    # das requisições. Se a inicialização falhar, o app sobe mesmo assim e o endpoint
+    # de chat responde 503 (mesmo comportamento de antes).
+    global openai_client, _warmup_complete
+    try:
+        openai_client = get_openai_client()
+    except Exception as e:
+        logger.error("Falha ao inicializar o cliente Azure OpenAI ou credenciais: %s", e)
+        openai_client = None # Garante que o cliente não seja usado se a inicialização falhar
+
+    # Pré-aquecimento: resolve a cadeia de credenciais e busca o primeiro token AAD
+    # (DNS + TLS + IMDS) agora, para que a primeira requisição real não pague o
+    # caminho frio de autenticação — relevante em ambientes com autoscale, onde
+    # cada pod novo repetiria esse custo no primeiro /api/chat.
+    if openai_client is not None:
+        try:
+            await get_token_provider()()
+        except Exception as e:
+            logger.warning("Pré-aquecimento de credenciais falhou; a 1ª requisição pagará o caminho frio: %s", e)
+    _warmup_complete = True
+
+
+@app.get("/ready", summary="Sonda de prontidão (readiness)")
+async def readiness_check():
+    # Responde 200 somente após o warmup, para o orquestrador (ex.: readinessProbe
+    # do k8s) não rotear tráfego para um processo que ainda está inicializando.
+    if not _warmup_complete or openai_client is None:
+        raise HTTPException(status_code=503, detail="Aplicação ainda não está pronta.")
+    return {"status": "ready"}
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Fecha o cliente compartilhado para liberar as conexões do pool de forma limpa.
+    if openai_client is not None:
+        await openai_client.close()
+    # O pool HTTP é nosso (o SDK não fecha clientes fornecidos externamente).
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+    # A credencial mantém sua própria sessão HTTP (IMDS/AAD); fecha só se foi criada.
+    if get_credential.cache_info().currsize:
+        await get_credential().close()
+
+
+def _prepare_chat_payload(request: ChatRequest):
+    """Validação e montagem do payload compartilhadas pelos endpoints de chat
+    (com e sem streaming).
+
+    Manter um único caminho quente — em vez de variantes quase idênticas por
+    endpoint — também permite que o interpretador adaptativo do CPython
+    (PEP 659) especialize o bytecode deste trecho após o aquecimento.
+    """
+    # Rejeições baratas primeiro: requisição malformada cai fora antes de qualquer
+    # checagem de infraestrutura — o que importa quando um cliente quebrado inunda
+    # o serviço — e o 400 não é mascarado pelo 503 de servidor mal configurado.
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="Nenhuma mensagem de usuário encontrada no request.")
 
-    # Pegar a última mensagem do usuário para a consulta
-    # Para um chat real, você deveria enviar um histórico mais completo das mensagens.
-    user_message = next((msg.content for msg in reversed(request.messages) if msg.role == "user"), None)
+    # Pegar a última mensagem do usuário para a consulta.
+    # A API "on your data" funciona melhor com a pergunta do usuário como a última
+    # mensagem; o histórico completo da conversa ainda não é repassado ao modelo.
+    # Varredura reversa com break: para na primeira mensagem de usuário encontrada,
+    # sem alocar generator + next por requisição.
+    user_message = None
+    for msg in reversed(request.messages):
+        if msg.role == "user":
+            user_message = msg.content
+            break
     if not user_message:
         raise HTTPException(status_code=400, detail="Nenhuma mensagem de usuário encontrada no request.")
 
-    # Montar a lista de mensagens para a API. Idealmente, incluiria o histórico da conversa.
-    # Por simplicidade, este exemplo apenas pega a última mensagem do usuário.
-    # Para um sistema de chat completo, você precisaria gerenciar e passar o histórico da conversa.
-    # messages_for_api = [{"role": msg.role, "content": msg.content} for msg in request.messages]
-    
-    # A API "on your data" geralmente funciona melhor com a pergunta do usuário como a última mensagem
-    # e o sistema pode precisar de um prompt de sistema.
-    # O exemplo do tutorial não detalha a construção de `messages`,
-    # mas foca no `extra_body` com `data_sources`.
-    # Assumindo que a última mensagem é a pergunta principal.
+    if not openai_client:
+        # Retry-After: indisponibilidade de inicialização tende a ser transitória
+        # (warmup em andamento ou pod reciclando); o cliente deve recuar e repetir.
+        raise HTTPException(status_code=503, detail="Serviço OpenAI não está disponível devido a erro de configuração.",
+                            headers={"Retry-After": "5"})
+    if not CONFIG_OK: # Pré-computado no import; nada a reavaliar por requisição
+        raise HTTPException(status_code=500, detail=MISSING_VARS_DETAIL)
+
+    # Aplica o orçamento de tokens à pergunta antes de enviá-la ao modelo.
+    user_message = _trim_to_token_budget(user_message, AZURE_OPENAI_CONTEXT_TOKEN_BUDGET)
+
     messages_for_api = [
-        # {"role": "system", "content": "Você é um assistente de IA útil que responde perguntas com base nos documentos fornecidos."},
+        SYSTEM_MESSAGE,
         {"role": "user", "content": user_message}
     ]
 
+    # A fonte de dados é um constante de módulo, passada por referência.
+    return messages_for_api, DATA_SOURCE
+
+
+# Despacho de erros por tipo concreto de exceção, resolvido uma única vez por
+# falha — em vez da cadeia de sondagens hasattr que rodava a cada erro (relevante
+# sob tempestades de rate limit, quando todo request cai aqui).
+_EXC_HANDLERS = (
+    (APIStatusError, lambda e: (e.status_code, getattr(e, "message", None) or str(e))),
+    (HttpResponseError, lambda e: (e.status_code or 500, getattr(e, "message", None) or str(e))),
+    (APIError, lambda e: (500, getattr(e, "message", None) or str(e))),
+)
 
-    # Configurar a fonte de dados (Azure AI Search) [cite: 117, 121]
-    data_source = {
-        "type": "azure_search",
-        "parameters": {
-            "endpoint": AZURE_SEARCH_ENDPOINT,
-            "index_name": AZURE_SEARCH_INDEX_NAME,
-            "authentication": {
-                "type": "system_assigned_managed_identity" # [cite: 4, 117]
-            },
-            "query_type": "vector_semantic_hybrid", # [cite: 121]
-            "semantic_configuration": f"{AZURE_SEARCH_INDEX_NAME}-semantic-configuration", # [cite: 121, 125]
-            "embedding_dependency": { # [cite: 121]
-                "type": "deployment_name",
-                "deployment_name": AZURE_OPENAI_EMBEDDING_DEPLOYMENT
-            },
-            # Outros parâmetros opcionais:
-            # "top_n_documents": 5,
-            # "strictness": 3,
-            # "in_scope": True, # Forçar o modelo a usar apenas os dados do índice
-            # "role_information": "Você é um assistente de IA que ajuda usuários com informações de documentos."
-        }
-    }
 
+def _error_status_detail(e: Exception):
+    # Defesa contra embrulho de TaskGroup (Python 3.11+): um ExceptionGroup com
+    # uma única causa é desembrulhado para que o erro real alcance os handlers
+    # tipados abaixo, preservando status e mensagem do upstream.
+    while isinstance(e, BaseExceptionGroup) and len(e.exceptions) == 1:
+        e = e.exceptions[0]
+    for exc_type, extract in _EXC_HANDLERS:
+        if isinstance(e, exc_type):
+            return extract(e)
+    return 500, str(e)
+
+
+# Controle de admissão para o Azure OpenAI: o FastAPI despacha corrotinas sem
+# limite e o pool httpx apenas as serializaria, com memória ilimitada e ordem
+# injusta. O semáforo limita as chamadas em voo ao que o deployment (TPM/RPM)
+# comporta; o excedente falha rápido com 503 + Retry-After em vez de estourar
+# timeout no fundo da fila do pool.
+MAX_IN_FLIGHT_COMPLETIONS = int(os.getenv("MAX_IN_FLIGHT_COMPLETIONS", "32"))
+COMPLETION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("COMPLETION_QUEUE_TIMEOUT_SECONDS", "5"))
+
+completion_semaphore = asyncio.Semaphore(MAX_IN_FLIGHT_COMPLETIONS)
+SATURATED_DETAIL = "Serviço saturado no momento; tente novamente em instantes."
+
+
+# Contador de frequência de perguntas por instância: telemetria barata para
+# ajustar limiar/tamanho dos caches em produção. Atualizado em paralelo com a
+# espera da completion, fora do caminho crítico. Limitado como os demais caches:
+# ao passar do teto, a compactação mantém as perguntas mais frequentes e descarta
+# a cauda — sem isso, um worker de vida longa acumularia uma entrada (com o texto
+# inteiro da conversa) por pergunta única, para sempre.
+QUERY_STATS_MAX_ENTRIES = int(os.getenv("QUERY_STATS_MAX_ENTRIES", "2048"))
+_query_stats = Counter()
+
+
+async def _record_query_stats(cache_text: str):
     try:
-        logger.info(f"Enviando requisição para o deployment GPT: {AZURE_OPENAI_GPT_DEPLOYMENT}")
-        completion = await openai_client.chat.completions.create(
-            model=AZURE_OPENAI_GPT_DEPLOYMENT,
-            messages=messages_for_api,
-            extra_body={ # Para usar Azure AI Search como fonte de dados [cite: 18, 117]
-                "data_sources": [data_source]
-            },
-            stream=False # O tutorial usa stream=False [cite: 117]
-        )
+        _query_stats[cache_text] += 1
+        count = _query_stats[cache_text]
+        if count > 1:
+            logger.debug("Pergunta repetida %d vezes nesta instância.", count)
+        if len(_query_stats) > QUERY_STATS_MAX_ENTRIES:
+            # Compacta para metade do teto, amortizando o custo do most_common.
+            for key, _count in _query_stats.most_common()[QUERY_STATS_MAX_ENTRIES // 2:]:
+                del _query_stats[key]
+    except Exception: # Telemetria nunca deve derrubar a requisição
+        logger.debug("Falha ao registrar estatística de consulta.", exc_info=True)
+
+
+# Requisições idênticas em voo compartilham a mesma task (padrão single-flight).
+_in_flight = {} # chave de cache -> asyncio.Task produzindo a ChatResponse
+
+
+def _json_response(payload: bytes) -> Response:
+    # Devolve bytes JSON já prontos, sem passar de novo pelo response_model.
+    return Response(content=payload, media_type="application/json")
+
+
+def _discard_task(task: asyncio.Task):
+    # Cancela uma task especulativa; o callback consome o resultado/exceção para
+    # não gerar o aviso "Task exception was never retrieved".
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat_completion(request: ChatRequest):
+    messages_for_api, data_source = _prepare_chat_payload(request)
+
+    # Clientes podem pedir streaming no próprio /api/chat (stream=true no corpo):
+    # o servidor deixa de reter max_tokens de decodificação antes do 1º byte.
+    # O caminho bufferizado segue como default e é o único que alimenta os caches.
+    if request.stream:
+        return _stream_chat_response(messages_for_api, data_source)
+
+    # Chave textual compartilhada pelos caches exato e semântico: os últimos
+    # turnos de usuário, normalizados, unidos com um único str.join (uma alocação,
+    # sem concatenação incremental); incluir o histórico evita que a mesma pergunta
+    # final, em conversas diferentes, colida na mesma entrada. Filtrar por papel
+    # ANTES de fatiar garante que a pergunta extraída em _prepare_chat_payload
+    # sempre entre na chave, mesmo com uma cauda longa de mensagens de assistente.
+    user_turns = [msg.content for msg in request.messages if msg.role == "user"]
+    cache_text = "\n".join(_normalize_query(content) for content in user_turns[-6:])
+
+    # Sem chave confiável (turnos de usuário só com espaços), perguntas diferentes
+    # colidiriam na string vazia — e uma receberia a resposta cacheada da outra.
+    # Nesse caso executa direto, sem caches nem coalescência.
+    if not cache_text:
+        return _json_response(await _run_chat_completion(cache_text, messages_for_api, data_source))
+
+    # Cache exato primeiro: resolve repetições idênticas sem nenhuma chamada de rede.
+    cached_response = exact_cache.get(cache_text)
+    if cached_response is not None:
+        logger.info("Cache exato: reutilizando resposta de pergunta idêntica.")
+        return _json_response(cached_response)
+
+    # "Single-flight": se uma requisição idêntica já está em voo, aguarda o mesmo
+    # resultado em vez de disparar outra chamada ao Azure OpenAI. Sob rajadas da
+    # mesma pergunta isso colapsa N chamadas em 1 — o equivalente prático do
+    # micro-batching para chat, já que conversas distintas não podem ser agrupadas
+    # em um único prompt.
+    pending = _in_flight.get(cache_text)
+    if pending is not None:
+        logger.info("Coalescendo requisição idêntica já em voo.")
+        return _json_response(await asyncio.shield(pending))
+
+    run_task = asyncio.create_task(_run_chat_completion(cache_text, messages_for_api, data_source))
+    _in_flight[cache_text] = run_task
+    try:
+        # shield: a desconexão de um dos clientes não cancela a chamada
+        # compartilhada pelos demais.
+        return _json_response(await asyncio.shield(run_task))
+    finally:
+        _in_flight.pop(cache_text, None)
+
+
+async def _run_chat_completion(cache_text: str, messages_for_api, data_source) -> bytes:
+    # Admissão: se não houver vaga dentro do timeout, rejeita rápido com 503 e
+    # Retry-After para o cliente recuar, em vez de enfileirar sem limite.
+    try:
+        await asyncio.wait_for(completion_semaphore.acquire(), COMPLETION_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=SATURATED_DETAIL, headers={"Retry-After": "1"})
+    try:
+        return await _execute_chat_completion(cache_text, messages_for_api, data_source)
+    finally:
+        completion_semaphore.release()
+
+
+async def _execute_chat_completion(cache_text: str, messages_for_api, data_source) -> bytes:
+    # Dispara a chamada de chat completion especulativamente, em paralelo com o
+    # embedding + consulta ao cache semântico (padrão asyncio.gather/create_task).
+    # Em caso de hit no cache a chamada é cancelada cedo; em caso de miss o RTT do
+    # embedding (~dezenas de ms) sai do caminho crítico em vez de ser serial.
+    logger.info("Enviando requisição para o deployment GPT: %s", AZURE_OPENAI_GPT_DEPLOYMENT)
+    completion_task = asyncio.create_task(openai_client.chat.completions.create(
+        model=AZURE_OPENAI_GPT_DEPLOYMENT,
+        messages=messages_for_api,
+        extra_body={ # Para usar Azure AI Search como fonte de dados [cite: 18, 117]
+            "data_sources": [data_source]
+        },
+        stream=False # O tutorial usa stream=False [cite: 117]
+    ))
+
+    # Consulta o cache semântico enquanto a completion já está em voo (somente
+    # com chave não vazia; sem ela não há o que embedar nem onde gravar).
+    query_embedding = None
+    if cache_text:
+        try:
+            # Reutiliza o vetor se este texto já foi embedado recentemente.
+            query_embedding = embedding_cache.get(cache_text)
+            if query_embedding is None:
+                embedding_response = await openai_client.embeddings.create(
+                    model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                    input=cache_text
+                )
+                query_embedding = embedding_response.data[0].embedding
+                embedding_cache.put(cache_text, query_embedding)
+            cached_response = semantic_cache.get(query_embedding)
+            if cached_response is not None:
+                logger.info("Cache semântico: reutilizando resposta de pergunta similar.")
+                _discard_task(completion_task)
+                return cached_response
+        except Exception as e:
+            # Falha no embedding não deve derrubar a requisição; apenas segue sem cache.
+            logger.warning("Cache semântico indisponível nesta requisição: %s", e)
+
+    try:
+        # O TaskGroup sobrepõe o trabalho auxiliar (telemetria de frequência) à
+        # completion já em voo; chamadas auxiliares futuras (re-rank, sink de
+        # métricas) entram aqui sem somar latência ao caminho crítico. A
+        # completion é aguardada FORA do grupo: dentro dele, uma falha do Azure
+        # OpenAI sairia embrulhada em ExceptionGroup e escaparia dos handlers
+        # tipados de _error_status_detail (um 429 viraria 500 genérico).
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(_record_query_stats(cache_text))
+        completion = await completion_task
 
         response_message = completion.choices[0].message
 
         # Extrair citações do contexto da mensagem [cite: 100, 102]
+        # O serviço pode citar o mesmo chunk mais de uma vez; deduplicamos em uma
+        # única passada com um dict (que preserva a ordem de inserção), em vez de
+        # list(set(...)), que embaralharia a ordem das fontes para o cliente.
+        # `context` é um campo extra da API "on your data" e pode nem existir no
+        # objeto de resposta; resolvemos o acesso uma única vez com getattr +
+        # default, em vez de repetir sondagens de atributo/checagens de tipo.
+        response_context = getattr(response_message, "context", None) or {}
+        raw_citations = response_context.get("citations") or ()
         citations_data = []
-        if response_message.context and response_message.context.get("citations"):
-            for cit_data in response_message.context["citations"]:
-                citations_data.append(Citation(
-                    content=cit_data.get("content"),
+        if raw_citations:
+            unique_citations = {}
+            for cit_data in raw_citations:
+                key = (cit_data.get("chunk_id"), cit_data.get("content"))
+                if key not in unique_citations:
+                    unique_citations[key] = cit_data
+            # model_construct pula a validação do pydantic: o payload vem do
+            # próprio serviço "on your data" (fonte confiável, formato estável),
+            # então projetamos os campos conhecidos direto, sem pagar o validador
+            # campo a campo por citação.
+            citations_data = [
+                Citation.model_construct(
+                    content=cit_data.get("content", ""),
                     title=cit_data.get("title"),
                     url=cit_data.get("url"),
-                    filepath=cit_data.get("filepath"), # 'filepath' é mais comum que 'filename'
-                    chunk_id=cit_data.get("chunk_id")
-                ))
+                    filepath=cit_data.get("filepath"),
+                    chunk_id=cit_data.get("chunk_id"),
+                )
+                for cit_data in unique_citations.values()
+            ]
         
         # O conteúdo da resposta já pode conter referências como [doc1], [doc2] etc. [cite: 103]
         chat_response_content = response_message.content
 
-        return ChatResponse(
+        chat_response = ChatResponse(
             message=ChatCompletionMessage(
                 role="assistant",
                 content=chat_response_content,
@@ -184,28 +762,88 @@ async def chat_completion(request: ChatRequest):
             )
         )
 
-    except Exception as e:
-        logger.error(f"Erro ao chamar a API de Chat Completions: {e}")
-        # Verifique se 'e' é uma exceção da API OpenAI e capture detalhes específicos se necessário
-        # Por exemplo, e.status_code, e.response.json()
-        error_detail = str(e)
-        status_code = 500
-        if hasattr(e, 'status_code'): # Erros da API OpenAI podem ter status_code
-            status_code = e.status_code
-            if hasattr(e, 'message'):
-                error_detail = e.message
-            elif hasattr(e, 'body') and e.body and 'message' in e.body: # Para azure.core.exceptions.HttpResponseError
-                 error_detail = e.body['message']
-            elif hasattr(e, 'response') and hasattr(e.response, 'text'):
-                error_detail = e.response.text
+        # Serializa uma única vez (pydantic-core) e daqui em diante só circulam os
+        # bytes prontos: hits de cache e requisições coalescidas devolvem o payload
+        # sem repetir a validação de modelo nem a serialização do response_model.
+        response_bytes = chat_response.model_dump_json().encode("utf-8")
 
+        # Alimenta os caches para curto-circuitar perguntas repetidas ou similares.
+        if cache_text:
+            exact_cache.put(cache_text, response_bytes)
+            if query_embedding is not None:
+                semantic_cache.put(query_embedding, response_bytes)
 
+        return response_bytes
+
+    except Exception as e:
+        logger.error("Erro ao chamar a API de Chat Completions: %s", e)
+        status_code, error_detail = _error_status_detail(e)
         raise HTTPException(status_code=status_code, detail=f"Erro ao processar a requisição de chat: {error_detail}")
 
+def _stream_chat_response(messages_for_api, data_source) -> StreamingResponse:
+    # Em vez de esperar a resposta inteira ser decodificada no servidor
+    # (stream=False), envia os tokens via Server-Sent Events conforme chegam:
+    # o tempo até o primeiro byte cai de segundos para a latência do primeiro chunk.
+    async def event_generator():
+        # Mesmo controle de admissão do caminho bufferizado; aqui a vaga cobre a
+        # duração do stream. O status HTTP já foi enviado, então a saturação é
+        # sinalizada como evento de erro dentro do próprio stream.
+        try:
+            await asyncio.wait_for(completion_semaphore.acquire(), COMPLETION_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            yield b"event: error\ndata: " + orjson.dumps({"detail": SATURATED_DETAIL}) + b"\n\n"
+            return
+        try:
+            stream = await openai_client.chat.completions.create(
+                model=AZURE_OPENAI_GPT_DEPLOYMENT,
+                messages=messages_for_api,
+                extra_body={
+                    "data_sources": [data_source]
+                },
+                stream=True
+            )
+            citations = None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                # Na API "on your data" o contexto (citações) chega no primeiro chunk.
+                context = getattr(delta, "context", None)
+                if context and context.get("citations"):
+                    citations = context["citations"]
+                if delta.content:
+                    # orjson.dumps devolve bytes direto (sem o passo extra de
+                    # encode), que é o que o StreamingResponse escreve no socket.
+                    yield b"data: " + orjson.dumps({"content": delta.content}) + b"\n\n"
+            if citations:
+                yield b"event: citations\ndata: " + orjson.dumps(citations) + b"\n\n"
+            yield b"data: [DONE]\n\n"
+        except Exception as e:
+            # O status HTTP já foi enviado; sinaliza o erro dentro do próprio stream.
+            logger.error("Erro durante o streaming da resposta: %s", e)
+            yield b"event: error\ndata: " + orjson.dumps({"detail": str(e)}) + b"\n\n"
+        finally:
+            completion_semaphore.release()
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.post("/api/chat/stream", summary="Versão com streaming (SSE) do endpoint de chat")
+async def chat_completion_stream(request: ChatRequest):
+    messages_for_api, data_source = _prepare_chat_payload(request)
+    return _stream_chat_response(messages_for_api, data_source)
+
+
 @app.get("/health", summary="Verifica a saúde da aplicação")
 async def health_check():
     # Uma verificação de saúde básica. Pode ser expandida para checar a conectividade com os serviços Azure.
     return {"status": "ok", "openai_client_initialized": openai_client is not None}
 
 # Para executar localmente com Uvicorn (para desenvolvimento):
-# uvicorn main:app --reload
\ No newline at end of file
+# uvicorn main:app --reload
+if __name__ == "__main__":
+    import uvicorn
+
+    # Mesmo loop (uvloop) e parser HTTP (httptools) usados em produção via
+    # gunicorn.conf.py, para o desenvolvimento não esconder diferenças de runtime.
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
\ No newline at end of file